@@ -11,9 +11,24 @@ import urllib
 import urllib2
 import base64
 import json
+import time
+import socket
+import httplib
+import inspect
+import threading
+from Queue import Queue, Empty
+from heapq import heappush, heappop
+from collections import deque
 from itertools import ifilter
+from multiprocessing.pool import ThreadPool
 
-from .utils import RequestWithMethod, AutoReferencingList
+from .utils import RequestWithMethod, AutoReferencingList, Descending, \
+    LeanReferencingList, build_reference_map, ReferencingStream, projection, \
+    form_encode
+from .metrics import Metrics, LatencyTracker
+from .endpoints import EndpointSet
+from .multipart import MultipartBody
+from .memory import estimate, measure
 
 __version__ = "0.2"
 
@@ -32,12 +47,64 @@ class BaseAPI(object):
     #: provided by teambox in certain ocassions
     objectify = True
 
-    def __init__(self, base_url=None, username=None, password=None):
+    #: The opener used to send the requests. Built on the first request
+    #: unless one is set, for example by a :class:`~teambox.pool.ClientPool`
+    #: which shares openers between instances
+    url_opener = None
+
+    #: Seconds to wait for the connection and for each read from it before
+    #: a request fails. None waits as long as the socket default.
+    timeout = None
+
+    #: If set, a GET which has not been answered within this percentile of
+    #: the recently observed latencies of GETs is sent again and the first
+    #: answer is used. For example, 95 hedges the slowest 5% of requests.
+    hedge_percentile = None
+
+    #: The number of latency samples needed before requests are hedged
+    hedge_min_samples = 20
+
+    #: A :class:`~teambox.loader.ReferenceLoader` which, if set, fetches
+    #: the references missing in each objectified response
+    reference_loader = None
+
+    #: The fields of the objects kept when responses are objectified. All
+    #: the fields are kept if None. See :meth:`only`.
+    fields = None
+
+    #: The types of references kept when responses are objectified, as a
+    #: list or a dictionary of type to fields. See :meth:`only`.
+    reference_types = None
+
+    #: Approximate bytes an objectified response may take. A response that
+    #: would take more is built as a
+    #: :class:`~teambox.utils.LeanReferencingList`, or returned as a
+    #: :class:`~teambox.utils.ReferencingStream` if even the decoded
+    #: response exceeds the budget and :attr:`streaming` is set. The mode
+    #: chosen is counted in :attr:`metrics` as `memory.full`,
+    #: `memory.lean` or `memory.streaming`.
+    memory_budget = None
+
+    #: True if responses over the :attr:`memory_budget` may be returned as
+    #: a :class:`~teambox.utils.ReferencingStream`, which can be iterated
+    #: only once. See :meth:`streamed`.
+    streaming = False
+
+    #: A callable which, if set, is called with a
+    #: :class:`~teambox.memory.MemoryReport` of each objectified response
+    memory_callback = None
+
+    def __init__(self, base_url=None, username=None, password=None,
+            timeout=None):
         """
         :param username: The username to use for Basic password auth
         :param password: The password for Basic auth
         :param base_url: URL of teambox installation. Defaults to the hosted
-                         service at https://teambox.com
+                         service at https://teambox.com. A list of URLs
+                         could be given for an installation which runs on
+                         several replicas. See :meth:`make_request`.
+        :param timeout: Seconds to wait for the connection and each read
+                        before a request fails
         """
         if base_url is None:
             base_url = "https://teambox.com"
@@ -48,6 +115,26 @@ class BaseAPI(object):
             'Authorization': "Basic %s" % authorization
             }
         self.base_url = base_url
+        if timeout is not None:
+            self.timeout = timeout
+
+        #: Counters of the requests sent, shared with the instances created
+        #: using :meth:`frominstance`
+        self.metrics = Metrics()
+        self.latencies = LatencyTracker()
+
+    def _get_base_url(self):
+        return self.endpoints.endpoints[0].url
+
+    def _set_base_url(self, base_url):
+        if isinstance(base_url, basestring):
+            base_url = [base_url]
+        self.endpoints = EndpointSet(base_url)
+
+    #: URL of the teambox installation, the first of its endpoints if it
+    #: has several. Setting it replaces the endpoints with the URL or list
+    #: of URLs given.
+    base_url = property(_get_base_url, _set_base_url)
 
     @classmethod
     def frominstance(cls, instance):
@@ -55,8 +142,16 @@ class BaseAPI(object):
         """
         new_instance = cls()
         new_instance.headers = instance.headers
-        new_instance.base_url = instance.base_url
-        return new_instance 
+        new_instance.endpoints = instance.endpoints
+        new_instance.url_opener = instance.url_opener
+        new_instance.timeout = instance.timeout
+        new_instance.hedge_percentile = instance.hedge_percentile
+        new_instance.reference_loader = instance.reference_loader
+        new_instance.memory_budget = instance.memory_budget
+        new_instance.memory_callback = instance.memory_callback
+        new_instance.metrics = instance.metrics
+        new_instance.latencies = instance.latencies
+        return new_instance
 
     def objectify(self, response):
         """Objectifies data into lazy loading objects which lookup in
@@ -64,10 +159,93 @@ class BaseAPI(object):
         """
         if isinstance(response, dict) and ('objects' in response) \
                 and ('references' in response):
-            return AutoReferencingList.from_response(response)
+            reference_map = build_reference_map(
+                response['references'], self.reference_types
+            )
+            mode = 'full'
+            if self.memory_budget is not None:
+                objectified, decoded = estimate(response, reference_map)
+                if objectified > self.memory_budget:
+                    mode = 'streaming' if self.streaming and \
+                        decoded > self.memory_budget else 'lean'
+                self.metrics.incr('memory.%s' % mode)
+
+            if mode == 'streaming':
+                result = ReferencingStream(
+                    response['objects'], reference_map, self.fields
+                )
+                if self.reference_loader is not None:
+                    self.reference_loader.load(
+                        result.preview(), self.reference_types
+                    )
+            else:
+                list_class = LeanReferencingList if mode == 'lean' \
+                    else AutoReferencingList
+                result = list_class.from_teambox_objs(
+                    response['objects'], reference_map, self.fields
+                )
+                if self.reference_loader is not None:
+                    self.reference_loader.load(
+                        result, self.reference_types
+                    )
+            if self.memory_callback is not None:
+                self.memory_callback(measure(result))
+            return result
+        if isinstance(response, dict) and self.fields is not None:
+            return projection(response, self.fields)
         return response
 
-    def make_request(self, resource, data=None, method=None):
+    def only(self, fields=None, references=None):
+        """Returns a copy of the api whose responses keep only the given
+        fields and references. The rest are dropped as the response is
+        objectified, which saves memory on large results.
+
+        Example::
+
+            >>> comment_api = Comment(username="username", password="pw")
+            >>> comments = comment_api.only(
+            ...     ['status', 'assigned_id', 'due_on'],
+            ...     references={'person': ['user_id'], 'user': None}
+            ... ).index(project=1)
+
+        The copy works with all the methods that return objects, including
+        :meth:`filter`.
+
+        :param fields: The fields of the objects to keep. `id` and `type`
+                       are always kept.
+        :param references: The types of references to keep, in snake case,
+                           as a list or as a dictionary of the type to the
+                           fields to keep (None for all the fields)
+        """
+        new_instance = self.frominstance(self)
+        new_instance.fields = frozenset(fields) if fields is not None \
+            else None
+        new_instance.reference_types = references
+        new_instance.streaming = self.streaming
+        return new_instance
+
+    def streamed(self):
+        """Returns a copy of the api whose responses over the
+        :attr:`memory_budget` are returned as a
+        :class:`~teambox.utils.ReferencingStream` instead of a list, when
+        even the decoded response exceeds the budget. The objects of the
+        stream are released as it is iterated, and it can be iterated only
+        once.
+
+        Example::
+
+            >>> comment_api = Comment(username="username", password="pw")
+            >>> comment_api.memory_budget = 10 * 1024 * 1024
+            >>> for comment in comment_api.streamed().index(project=1):
+            ...     print comment['body']
+        """
+        new_instance = self.frominstance(self)
+        new_instance.fields = self.fields
+        new_instance.reference_types = self.reference_types
+        new_instance.streaming = True
+        return new_instance
+
+    def make_request(self, resource, data=None, method=None, headers=None):
         """
         Send a request
 
@@ -77,17 +255,87 @@ class BaseAPI(object):
             interface. See :meth:`post`, :meth:`get`, :meth:`delete` and 
             :meth:`put`
 
+        When the installation has several endpoints, the request is sent
+        to the endpoint expected to answer first (see
+        :class:`~teambox.endpoints.EndpointSet`). A GET which fails to get
+        an answer or gets a server error is retried on the other endpoints.
+        Other requests are never sent to an endpoint which has been
+        failing until a GET has found it healthy again.
+
         :param resource: resource path without / in beginning
+        :param data: The body of the request as a string or as a file like
+                     object, which is then sent as it is read
+        :param headers: Headers sent in addition to :attr:`headers`
         :param objectify: A flag to indicate if the response must be 
                           objectified
         """
-        url_opener = urllib2.build_opener(
-            urllib2.HTTPCookieProcessor(),
-            urllib2.HTTPSHandler(),
-            )
-        url = '/'.join([self.base_url, "api/%s" % self.api_version, resource])
-        request = RequestWithMethod(url, data, self.headers, method=method)
-        response = json.loads(url_opener.open(request).read())
+        if headers:
+            headers = dict(self.headers, **headers)
+        else:
+            headers = self.headers
+
+        if self.url_opener is None:
+            self.url_opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(),
+                urllib2.HTTPSHandler(),
+                )
+
+        # Only requests which are safe to repeat are sent to another
+        # endpoint when the first one fails, or used to probe an endpoint
+        # which has been failing
+        retry = data is None and method is None
+        tried, last_error = [], None
+        while True:
+            endpoint = self.endpoints.acquire(exclude=tried, probe=retry)
+            if endpoint is None:
+                if last_error is not None:
+                    raise last_error
+                raise urllib2.URLError(
+                    "No endpoint of the installation is available"
+                )
+            tried.append(endpoint)
+
+            url = '/'.join([
+                endpoint.url, "api/%s" % self.api_version, resource
+            ])
+            request = RequestWithMethod(url, data, headers, method=method)
+
+            self.metrics.incr('requests')
+            start = time.time()
+            try:
+                if self.timeout is None:
+                    response = self.url_opener.open(request).read()
+                else:
+                    response = self.url_opener.open(
+                        request, timeout=self.timeout
+                    ).read()
+            except urllib2.HTTPError as error:
+                if error.code < 500:
+                    # The endpoint is fine, the request is not
+                    self.endpoints.release(
+                        endpoint, time.time() - start if retry else None
+                    )
+                    raise
+                self.endpoints.release(endpoint, failed=True)
+                last_error = error
+            except (urllib2.URLError, socket.error,
+                    httplib.HTTPException) as error:
+                self.endpoints.release(endpoint, failed=True)
+                last_error = error
+            else:
+                # Only the latency of reads is recorded, as writes and
+                # uploads take as long as their bodies take to send
+                latency = time.time() - start if retry else None
+                self.endpoints.release(endpoint, latency)
+                if latency is not None:
+                    self.latencies.add(latency)
+                break
+
+            self.metrics.incr('failures')
+            if not retry:
+                raise last_error
+
+        response = json.loads(response)
 
         if not self.objectify:
             return response
@@ -96,19 +344,133 @@ class BaseAPI(object):
     def post(self, resource, data):
         """A proxy for :meth:`make_request` which sends a post to given uri
         """
-        return self.make_request(resource, urllib.urlencode(data))
+        return self.make_request(resource, form_encode(data))
 
     def get(self, resource):
         """ proxy for :meth:`make_request` which sends a GET to given uri
+
+        If :attr:`hedge_percentile` is set the request is hedged. See
+        :meth:`hedged_request`.
         """
+        if self.hedge_percentile is not None:
+            return self.hedged_request(resource)
         return self.make_request(resource)
 
+    def hedged_request(self, resource):
+        """Sends a GET and, if there is no answer within
+        :attr:`hedge_percentile` of the recent latencies, sends the same
+        request again. The first successful answer is returned. Only use
+        this for requests which are safe to repeat.
+
+        The counters `hedge.eligible`, `hedge.sent` and `hedge.won` (the
+        duplicate answered first) are kept in :attr:`metrics`. The hedging
+        rate is ``metrics.rate('hedge.sent', 'hedge.eligible')``.
+        """
+        if len(self.latencies) < self.hedge_min_samples:
+            return self.make_request(resource)
+        delay = self.latencies.percentile(self.hedge_percentile)
+        self.metrics.incr('hedge.eligible')
+
+        answers = Queue()
+
+        def attempt(index):
+            try:
+                answers.put((index, True, self.make_request(resource)))
+            except Exception as exception:
+                answers.put((index, False, exception))
+
+        def start(index):
+            thread = threading.Thread(target=attempt, args=(index,))
+            thread.daemon = True
+            thread.start()
+
+        start(0)
+        try:
+            index, success, result = answers.get(timeout=delay)
+            pending = 0
+        except Empty:
+            self.metrics.incr('hedge.sent')
+            start(1)
+            index, success, result = answers.get()
+            pending = 1
+
+        if not success and pending:
+            # Fall back to the answer of the other request
+            index, success, result = answers.get()
+        if not success:
+            raise result
+        if index == 1:
+            self.metrics.incr('hedge.won')
+        return result
+
     def delete(self, resource):
-        return self.make_reqeust(resource, method="DELETE")
+        return self.make_request(resource, method="DELETE")
 
     def put(self, resource, data):
+        """A proxy for :meth:`make_request` which sends a PUT to given uri
+        """
+        if data is not None:
+            data = form_encode(data)
         return self.make_request(resource, data, method="PUT")
 
+    def save(self, record, clear_removed=False, **kwargs):
+        """Saves the fields of an objectified record which have changed,
+        using the `update` method of the api. Nothing is sent if no field
+        has changed.
+
+        This works with the apis whose `update` takes the id of the record
+        and the data, like :meth:`Project.update` or
+        :meth:`Comment.update`. Keyword arguments are propogated to the
+        update method.
+
+        Fields removed from the record are not sent, so that fields can be
+        dropped to save memory without losing them on teambox. Set
+        `clear_removed` to blank them on teambox instead.
+
+        Example::
+
+            >>> project_api = Project(username="username", password="password")
+            >>> project = project_api.show(1)[0]
+            >>> project['name'] = 'New name'
+            >>> project_api.save(project)   # Sends only the name
+
+        :return: The response of the update or None if nothing was sent
+        """
+        if not hasattr(self, 'update'):
+            raise Exception("This API has no update method implemented")
+        if inspect.getargspec(self.update).args[2:3] != ['data']:
+            raise Exception(
+                "%s.update does not take the data of a record and cannot "
+                "be used to save it" % self.__class__.__name__
+            )
+
+        changes = record.changes(removed=clear_removed)
+        if not changes:
+            self.metrics.incr('save.skipped')
+            return None
+        result = self.update(record['id'], changes, **kwargs)
+        record.mark_clean()
+        return result
+
+    def save_all(self, records, workers=1, **kwargs):
+        """Saves each of the records with :meth:`save`. Records which have
+        not changed are skipped without a request.
+
+        :param workers: Number of records saved at a time
+        :return: The responses of the updates that were sent
+        """
+        records = list(records)
+        changed = [record for record in records if record.dirty]
+        self.metrics.incr('save.skipped', len(records) - len(changed))
+        records = changed
+        if workers > 1 and len(records) > 1:
+            pool = ThreadPool(min(workers, len(records)))
+            try:
+                return pool.map(lambda r: self.save(r, **kwargs), records)
+            finally:
+                pool.close()
+        return [self.save(record, **kwargs) for record in records]
+
     def filter(self, predicate, *args, **kwargs):
         """Filter the output based on attributes. 
 
@@ -345,7 +707,7 @@ class Activity(BaseAPI):
     """An activity is a record of what happened in a :class:`Project`.
     """
 
-    def index(self, project=None, threads=None):
+    def index(self, project=None, threads=None, max_id=None, count=None):
         """Returns the most recent activities in the project. 
 
         Related objects required to reconstruct a Teambox timeline are stored 
@@ -357,13 +719,97 @@ class Activity(BaseAPI):
 
         This is ideal for apps that want to display a compact view of 
         activities (such as the collapsed view on the web version).
+
+        :param max_id: Only return activities older than this activity, to
+                       page through the activities
+        :param count: The number of activities to return
         """
         path = "projects/%d/activities" % project if project \
             else "activities"
+        params = []
         if threads is not None:
-            path = "%s?threads=%s" % (path, (threads and "true" or "false"))
+            params.append(('threads', threads and "true" or "false"))
+        if max_id is not None:
+            params.append(('max_id', max_id))
+        if count is not None:
+            params.append(('count', count))
+        if params:
+            path = "%s?%s" % (path, urllib.urlencode(params))
         return self.get(path)
 
+    def pages(self, project=None, threads=None, count=None):
+        """Yields the activities of the project a page at a time, newest
+        first. A page is only fetched when the previous one has been
+        consumed.
+        """
+        max_id = None
+        while True:
+            page = self.index(project, threads, max_id=max_id, count=count)
+            if not isinstance(page, list):
+                # A stream is consumed by the caller before the next page
+                page = list(page)
+            if max_id is not None:
+                page = [a for a in page if a['id'] < max_id]
+            if not page:
+                return
+            yield page
+            max_id = min(activity['id'] for activity in page)
+
+    def timeline(self, projects, threads=None, count=None, workers=4):
+        """Yields the activities of several projects as one timeline, newest
+        first.
+
+        The first page of every project is fetched concurrently and the
+        pages are merged as the timeline is consumed. The next page of a
+        project is fetched in the background once the consumer has taken
+        the last activity of its current page, so showing the latest few
+        activities costs a page per project.
+
+        Example::
+
+            >>> activity_api = Activity(username="username", password="pw")
+            >>> latest = list(islice(activity_api.timeline([1, 2, 3]), 20))
+
+        :param projects: The ids of the projects
+        :param count: The number of activities fetched per page
+        :param workers: Number of pages fetched at a time
+        """
+        key = lambda activity: Descending(
+            (activity['created_at'], activity['id'])
+        )
+        streams = [self.pages(project, threads, count) for project in projects]
+        if not streams:
+            return
+
+        pool = ThreadPool(min(workers, len(streams)))
+        pending = dict(
+            (index, pool.apply_async(next, (stream, None)))
+            for index, stream in enumerate(streams)
+        )
+        buffers, heap = {}, []
+        try:
+            while True:
+                for index, result in pending.iteritems():
+                    page = result.get()
+                    if page:
+                        buffers[index] = deque(page)
+                        heappush(heap, (key(page[0]), index))
+                pending = {}
+                if not heap:
+                    return
+
+                ignore, index = heappop(heap)
+                activity = buffers[index].popleft()
+                if buffers[index]:
+                    heappush(heap, (key(buffers[index][0]), index))
+                else:
+                    pending[index] = pool.apply_async(
+                        next, (streams[index], None)
+                    )
+                yield activity
+        finally:
+            pool.close()
+
     def show(self, activity, project=None):
         """Returns the data for an activity in the project.
         """
@@ -540,7 +986,7 @@ class TaskList(BaseAPI):
             path = "projects/%d/%s" % (project, path)
 
         if archived is not None:
-            path = "%s?archived=%s" % (archived and "true" or "false")
+            path = "%s?archived=%s" % (path, archived and "true" or "false")
         return self.get(path)
 
     def reorder(self, project, order):
@@ -573,3 +1019,78 @@ class TaskList(BaseAPI):
         if project:
             path = "projects/%d/%s" % (project, path)
         return self.put(path, data)
+
+
+class Upload(BaseAPI):
+    """An upload is a file in a :class:`Project`, which could be attached
+    to a comment or a task.
+
+    Files are sent as multipart bodies streamed from the disk, so the size
+    of a file does not change the memory used to upload it.
+    """
+
+    def index(self, project):
+        """Returns the most recent uploads in the project.
+        """
+        path = "projects/%d/uploads" % project
+        return self.get(path)
+
+    def show(self, project, upload):
+        """Returns the data for an upload.
+        """
+        path = "projects/%d/uploads/%d" % (project, upload)
+        return self.get(path)
+
+    def destroy(self, project, upload):
+        """Destroys an upload.
+        """
+        path = "projects/%d/uploads/%d" % (project, upload)
+        return self.delete(path)
+
+    def create(self, project, filename, data=None, comment=None, task=None,
+            progress=None):
+        """Uploads a file to the project.
+
+        :param filename: Path of the file to upload
+        :param data: Other fields of the upload, like
+                     `{'upload[description]': 'Logo'}`
+        :param comment: Id of the comment to attach the file to
+        :param task: Id of the task to attach the file to
+        :param progress: A callable which is called with the bytes sent so
+                         far and the total bytes as the file is sent
+        """
+        fields = dict(data or {})
+        if comment is not None:
+            fields['upload[comment_id]'] = comment
+        if task is not None:
+            fields['upload[task_id]'] = task
+
+        body = MultipartBody(fields, {'upload[asset]': filename}, progress)
+        path = "projects/%d/uploads" % project
+        return self.make_request(path, body, headers={
+            'Content-Type': body.content_type,
+            'Content-Length': str(len(body)),
+        })
+
+    def create_many(self, project, filenames, data=None, workers=4,
+            progress=None):
+        """Uploads many files to the project, a few at a time. Returns the
+        responses in the order of the files.
+
+        :param filenames: Paths of the files to upload
+        :param data: Other fields of each upload, as in :meth:`create`
+        :param workers: Number of files uploaded at a time
+        :param progress: A callable which is called with the file name, the
+                         bytes sent so far and the total bytes of the file
+        """
+        def upload(filename):
+            callback = None
+            if progress is not None:
+                callback = lambda sent, total: progress(filename, sent, total)
+            return self.create(project, filename, data, progress=callback)
+
+        pool = ThreadPool(max(1, min(workers, len(filenames))))
+        try:
+            return pool.map(upload, filenames)
+        finally:
+            pool.close()
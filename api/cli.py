@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+    cli
+
+    The teambox command line tool to call the api in bulk
+
+    Every row of the input is one call of the method. The keys of the row
+    are the arguments of the method and the results are written to the
+    output as newline delimited JSON, one line per record. Examples::
+
+        # Export the comments of a few projects with 8 workers
+        $ echo '{"project": 1}
+        {"project": 2}' | teambox -u user -p pass -w 8 comment index
+
+        # Create task lists from a CSV with the columns project,data.name
+        $ teambox -u user -p pass -i lists.csv --rate 5 task_list create
+
+        # A single call with the arguments on the command line
+        $ teambox -u user -p pass project show project=12
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import getpass
+import threading
+import urllib2
+from itertools import islice
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+
+from . import Project, Comment, TaskList, Membership, Activity
+from .pool import KeepAliveHandler
+from .utils import LazyReferenceDescriptor
+
+
+#: The resources exposed on the command line
+RESOURCES = {
+    'project': Project,
+    'comment': Comment,
+    'task_list': TaskList,
+    'membership': Membership,
+    'activity': Activity,
+}
+
+
+class RateLimiter(object):
+    """Spaces out calls made from many threads so that not more than
+    `rate` calls start in a second
+
+    :param rate: Calls per second. None or 0 does not limit the calls
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_value(value):
+    """Converts an argument of a call given as a string. Integers are
+    converted as the api expects ids to be integers.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_row(row):
+    """Builds the arguments of a call from a flat row. A key like
+    `data.name` is set as `name` in the `data` argument, as it is given
+    since it is sent to teambox as a string anyway. Empty values are left
+    out.
+    """
+    arguments = {}
+    for key, value in row.iteritems():
+        if value is None or value == '':
+            continue
+        if '.' in key:
+            key, sub_key = key.split('.', 1)
+            arguments.setdefault(key, {})[sub_key] = value
+        elif isinstance(value, basestring):
+            arguments[key] = parse_value(value)
+        else:
+            arguments[key] = value
+    return arguments
+
+
+def read_rows(stream, format):
+    """Yields the arguments of each call from a NDJSON or CSV stream
+    """
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            yield parse_row(row)
+        return
+
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield parse_row(json.loads(line))
+
+
+def records(result):
+    """Yields the records of the result of a call. Lists and the pages
+    yielded by generators are flattened.
+    """
+    if result is None:
+        return
+    if isinstance(result, dict) or not hasattr(result, '__iter__'):
+        yield result
+        return
+    for item in result:
+        for record in records(item):
+            yield record
+
+
+def to_json(value):
+    """Serialises a result as JSON. References are written as the id they
+    point to.
+    """
+    def default(obj):
+        if isinstance(obj, LazyReferenceDescriptor):
+            return obj.target_id
+        raise TypeError("%r is not JSON serializable" % obj)
+    return json.dumps(value, default=default)
+
+
+def methods(api_class):
+    """Returns the names of the methods of the resource which can be called
+    """
+    return sorted(
+        name for name, value in vars(api_class).iteritems()
+        if callable(value) and not name.startswith('_')
+    )
+
+
+def build_parser():
+    parser = OptionParser(
+        usage="%prog [options] RESOURCE METHOD [NAME=VALUE ...]",
+        description="Calls METHOD of the teambox RESOURCE for each row of "
+            "the input and writes the results as newline delimited JSON. "
+            "Resources: %s" % ", ".join(sorted(RESOURCES)),
+    )
+    parser.add_option("--url", action="append", dest="urls",
+        help="URL of the teambox installation. Repeat for replicas.")
+    parser.add_option("-u", "--username",
+        default=os.environ.get('TEAMBOX_USERNAME'),
+        help="Defaults to $TEAMBOX_USERNAME")
+    parser.add_option("-p", "--password",
+        default=os.environ.get('TEAMBOX_PASSWORD'),
+        help="Defaults to $TEAMBOX_PASSWORD. Asked for if not given.")
+    parser.add_option("-i", "--input",
+        help="File with a row of arguments per call, '-' for stdin")
+    parser.add_option("-f", "--format", choices=["ndjson", "csv"],
+        help="Format of the input: ndjson or csv. Guessed from the file "
+            "name and ndjson by default.")
+    parser.add_option("-w", "--workers", type="int", default=4,
+        help="Number of calls made at a time [default: %default]")
+    parser.add_option("-r", "--rate", type="float",
+        help="Maximum number of calls started per second")
+    parser.add_option("-t", "--timeout", type="float",
+        help="Seconds to wait for an answer")
+    parser.add_option("-b", "--batch-size", type="int", default=100,
+        help="Number of rows read ahead of the calls [default: %default]")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+
+    if len(args) < 2:
+        parser.error("RESOURCE and METHOD are required")
+    resource, method = args[0].lower(), args[1]
+    if resource not in RESOURCES:
+        parser.error("Unknown resource %s" % resource)
+    api_class = RESOURCES[resource]
+    if method not in methods(api_class):
+        parser.error("%s has no method %s. Methods: %s" % (
+            resource, method, ", ".join(methods(api_class))
+        ))
+
+    defaults = {}
+    for arg in args[2:]:
+        if '=' not in arg:
+            parser.error("Arguments must be given as NAME=VALUE")
+        name, value = arg.split('=', 1)
+        defaults[name] = value
+    defaults = parse_row(defaults)
+
+    if options.username and options.password is None:
+        options.password = getpass.getpass()
+
+    api = api_class(
+        options.urls, options.username, options.password, options.timeout
+    )
+    api.url_opener = urllib2.build_opener(
+        urllib2.HTTPCookieProcessor(),
+        KeepAliveHandler(max_idle=options.workers),
+    )
+    call_method = getattr(api, method)
+
+    if options.input:
+        stream = sys.stdin if options.input == '-' \
+            else open(options.input, 'rb')
+        format = options.format or (
+            'csv' if options.input.endswith('.csv') else 'ndjson'
+        )
+        rows = read_rows(stream, format)
+    else:
+        rows = iter([{}])
+
+    limiter = RateLimiter(options.rate)
+
+    def call(row):
+        arguments = dict(defaults, **row)
+        limiter.wait()
+        try:
+            # Generators are consumed here so that their requests are made
+            # by the worker and their errors are reported for the row
+            return row, list(records(call_method(**arguments))), None
+        except Exception as error:
+            return row, None, error
+
+    # The rows are read a batch at a time, so that a large input is not
+    # read into memory ahead of the calls
+    batch_size = max(options.batch_size, options.workers)
+    pool = ThreadPool(options.workers)
+    failures = 0
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            for row, result, error in pool.imap(call, batch):
+                if error is not None:
+                    failures += 1
+                    sys.stderr.write(
+                        to_json({'input': row, 'error': str(error)}) + '\n'
+                    )
+                    continue
+                for record in result:
+                    sys.stdout.write(to_json(record) + '\n')
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
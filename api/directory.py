@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    directory
+
+    A deduplicated directory of the users of an organization with their
+    roles, for lookups which do not need a request
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .utils import raw_value
+
+
+class UserDirectory(object):
+    """The users of an organization and their roles in the organization
+    and in each of its projects.
+
+    Every user is kept once, however many responses it came back in. The
+    memberships of the organization and the people of each project are
+    fetched concurrently, keeping only the fields the directory needs.
+
+    Example::
+
+        >>> directory = UserDirectory(
+        ...     Organization(username="username", password="password"), 1)
+        >>> directory.refresh()
+        >>> user = directory.by_username('john')
+        >>> directory.project_role(user['id'], 12)
+        3
+
+    Roles in the organization are those of :meth:`Membership.update` and
+    roles in a project are those of :meth:`Person.update`.
+
+    :param api: Any api, whose installation and credentials are used
+    :param organization: The id of the organization
+    :param workers: Number of requests made at a time
+    """
+
+    #: The fields kept from the memberships and people
+    fields = ['user_id', 'role', 'project_id']
+
+    #: The references kept from the responses, all the fields of users
+    references = {'user': None}
+
+    def __init__(self, api, organization, workers=4):
+        from . import Membership, Person, Project
+
+        self.organization = organization
+        self.workers = workers
+        self._memberships = Membership.frominstance(api).only(
+            self.fields, self.references
+        )
+        self._people = Person.frominstance(api).only(
+            self.fields, self.references
+        )
+        self._projects = Project.frominstance(api).only(['name'], [])
+        self._lock = threading.RLock()
+        self._index = _Index()
+
+    #: User id to the user
+    users = property(lambda self: self._index.users)
+
+    #: User id to the role in the organization
+    organization_roles = property(lambda self: self._index.organization_roles)
+
+    #: Project id to a dictionary of user id to the role in the project
+    project_roles = property(lambda self: self._index.project_roles)
+
+    #: User id to a dictionary of project id to the role in the project
+    user_projects = property(lambda self: self._index.user_projects)
+
+    def refresh(self):
+        """Fetches the memberships, the projects and the people of every
+        project of the organization and rebuilds the directory. Lookups
+        made while the directory is rebuilt are answered from the previous
+        one.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            memberships = pool.apply_async(
+                self._memberships.index, (self.organization,)
+            )
+            projects = self._projects.index(self.organization)
+            project_ids = [project['id'] for project in projects]
+            people = pool.map(self._people.index, project_ids)
+            memberships = memberships.get()
+        finally:
+            pool.close()
+
+        index = _Index()
+        index.set_memberships(memberships)
+        for project, project_people in zip(project_ids, people):
+            index.set_project(project, project_people)
+        with self._lock:
+            self._index = index
+
+    def refresh_project(self, project):
+        """Fetches the people of a single project and updates the directory
+        """
+        people = self._people.index(project)
+        with self._lock:
+            self._index.set_project(project, people)
+
+    def refresh_memberships(self):
+        """Fetches the memberships of the organization and updates the roles
+        in the organization
+        """
+        memberships = self._memberships.index(self.organization)
+        with self._lock:
+            self._index.set_memberships(memberships)
+
+    def user(self, user_id):
+        """Returns the user with the id or None
+        """
+        return self.users.get(user_id)
+
+    def by_username(self, username):
+        """Returns the user with the username or None
+        """
+        return self._index.usernames.get(username)
+
+    def organization_role(self, user_id):
+        """Returns the role of the user in the organization or None if the
+        user is not a member
+        """
+        return self.organization_roles.get(user_id)
+
+    def project_role(self, user_id, project):
+        """Returns the role of the user in the project or None if the user
+        is not in the project
+        """
+        return self.project_roles.get(project, {}).get(user_id)
+
+    def members(self, project):
+        """Returns a dictionary of the id of each user in the project to
+        their role
+        """
+        return dict(self.project_roles.get(project, {}))
+
+    def projects(self, user_id):
+        """Returns a dictionary of the id of each project the user is in to
+        their role
+        """
+        return dict(self.user_projects.get(user_id, {}))
+
+
+class _Index(object):
+    """The lookups of a :class:`UserDirectory`. Entries are replaced rather
+    than removed and added again, so that a lookup made while the index
+    is updated never misses an entry which is kept.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.usernames = {}
+        self.organization_roles = {}
+        self.project_roles = {}
+        self.user_projects = {}
+
+    def add_users(self, result):
+        """Adds the users in the references of a response. A user already
+        in the directory is replaced only by a more recently updated copy.
+        """
+        reference_map = getattr(result, 'reference_map', None) or {}
+        for user_id, user in reference_map.get('user', {}).iteritems():
+            existing = self.users.get(user_id)
+            if existing is not None and \
+                    user.get('updated_at') <= existing.get('updated_at'):
+                continue
+            self.users[user_id] = user
+            if user.get('username') is not None:
+                self.usernames[user['username']] = user
+            if existing is not None and \
+                    existing.get('username') != user.get('username'):
+                self.usernames.pop(existing.get('username'), None)
+
+    def set_memberships(self, memberships):
+        """Replaces the roles in the organization with those of the
+        memberships
+        """
+        self.organization_roles = dict(
+            (raw_value(m['user_id']), m['role']) for m in memberships
+        )
+        self.add_users(memberships)
+
+    def set_project(self, project, people):
+        """Replaces the roles in the project with those of the people
+        """
+        roles = {}
+        for person in people:
+            roles[raw_value(person['user_id'])] = person['role']
+
+        previous = self.project_roles.get(project, {})
+        self.project_roles[project] = roles
+        for user_id, role in roles.iteritems():
+            self.user_projects.setdefault(user_id, {})[project] = role
+        for user_id in previous:
+            if user_id not in roles:
+                self.user_projects.get(user_id, {}).pop(project, None)
+        self.add_users(people)
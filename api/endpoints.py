@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    endpoints
+
+    Health tracking and routing for installations of teambox which run
+    on several replicas
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """Stops requests to an endpoint which keeps failing.
+
+    The breaker is closed to begin with and opens after
+    `failure_threshold` consecutive failures. Once `reset_timeout` seconds
+    have passed, a single request is let through as a probe (half open).
+    The breaker closes if the probe succeeds and opens again if it fails.
+    Only requests which are safe to repeat are used as probes, see
+    :meth:`EndpointSet.acquire`.
+
+    The breaker is not thread safe by itself and is used under the lock
+    of the :class:`EndpointSet` it belongs to.
+
+    :param failure_threshold: Consecutive failures which open the breaker
+    :param reset_timeout: Seconds to wait before probing an open breaker
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def available(self):
+        """Returns True if a request may be sent now
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.time() - self.opened_at >= self.reset_timeout
+        # A probe is already in flight
+        return False
+
+    def probing(self):
+        """Returns True if the next request would be a probe
+        """
+        return self.state == self.OPEN and self.available()
+
+    def acquire(self):
+        """Marks that a request is being sent
+        """
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or \
+                self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.time()
+
+
+class Endpoint(object):
+    """A replica of the installation
+
+    :param url: Base URL of the replica
+    """
+
+    #: Weight of the latest sample in the moving average of the latency
+    smoothing = 0.3
+
+    def __init__(self, url, breaker):
+        self.url = url
+        self.breaker = breaker
+        self.latency = None
+        self.in_flight = 0
+
+    def score(self):
+        """Expected wait for a request sent to this endpoint. Endpoints
+        which have not answered yet score 0 so that they are tried.
+        """
+        return (self.latency or 0.0) * (self.in_flight + 1)
+
+    def __repr__(self):
+        return u'<Endpoint %s (%s)>' % (self.url, self.breaker.state)
+
+
+class EndpointSet(object):
+    """The endpoints of an installation with the routing of requests
+    between them.
+
+    Requests go to the available endpoint which is expected to answer
+    first, based on the moving average of its latency and the requests it
+    is already serving. An endpoint whose breaker is ready for a probe is
+    preferred so that recovered replicas are brought back quickly.
+
+    The breakers only apply when there are several endpoints. A single
+    endpoint is always tried, since refusing requests to it only turns a
+    short outage into a longer one.
+
+    :param urls: The base URLs of the replicas
+    :param failure_threshold: See :class:`CircuitBreaker`
+    :param reset_timeout: See :class:`CircuitBreaker`
+    """
+
+    def __init__(self, urls, failure_threshold=5, reset_timeout=30):
+        self.endpoints = [
+            Endpoint(url, CircuitBreaker(failure_threshold, reset_timeout))
+            for url in urls
+        ]
+        #: False for a single endpoint, whose breaker is not used
+        self.breaking = len(self.endpoints) > 1
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self, exclude=(), probe=True):
+        """Picks the endpoint for a request and marks it as serving the
+        request. Returns None if no endpoint is available.
+
+        :param exclude: Endpoints which must not be picked, for example
+                        those already tried for the request
+        :param probe: False if the request must not be sent to an endpoint
+                      which is not known to be healthy, because it is not
+                      safe to repeat. Such a request is only sent to
+                      endpoints whose breaker is closed.
+        """
+        with self._lock:
+            candidates = [
+                endpoint for endpoint in self.endpoints
+                if endpoint not in exclude and self._usable(endpoint, probe)
+            ]
+            if not candidates:
+                return None
+            probes = [e for e in candidates if e.breaker.probing()]
+            endpoint = probes[0] if probes \
+                else min(candidates, key=lambda e: e.score())
+            if self.breaking:
+                endpoint.breaker.acquire()
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _usable(self, endpoint, probe):
+        if not self.breaking:
+            return True
+        if probe:
+            return endpoint.breaker.available()
+        return endpoint.breaker.state == CircuitBreaker.CLOSED
+
+    def release(self, endpoint, latency=None, failed=False):
+        """Records the outcome of a request sent to the endpoint
+
+        :param latency: Seconds taken to answer if it was answered
+        :param failed: True if the endpoint failed to answer
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+            if failed:
+                if self.breaking:
+                    endpoint.breaker.failure()
+                return
+            if self.breaking:
+                endpoint.breaker.success()
+            if latency is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += endpoint.smoothing * \
+                        (latency - endpoint.latency)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    loader
+
+    Batched loading of referenced objects which teambox did not send in
+    the references of a response
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from multiprocessing.pool import ThreadPool
+
+from .utils import LazyReferenceDescriptor
+
+
+def _show(api_class):
+    """Returns a fetcher which calls the show method of the api class
+    """
+    def fetch(api, target_id):
+        instance = api_class.frominstance(api)
+        # The fetched objects are not loaded recursively
+        instance.reference_loader = None
+        return instance.show(target_id)
+    return fetch
+
+
+class ReferenceLoader(object):
+    """Fetches the objects which records refer to but which are missing in
+    the references of the response, in a single pass over the records.
+
+    The missing objects of all the records are collected first, each
+    object is fetched once with a few requests at a time and the objects
+    are then added to the reference map, so that the records can look them
+    up like any other reference.
+
+    Example::
+
+        >>> comment_api = Comment(username="username", password="password")
+        >>> comments = comment_api.index(project=1)
+        >>> ReferenceLoader(comment_api).load(comments)
+
+    Setting the loader on an api loads the missing references of every
+    response, so that nested lookups in :meth:`~teambox.BaseAPI.filter`
+    work::
+
+        >>> comment_api.reference_loader = ReferenceLoader(comment_api)
+        >>> comment_api.filter(
+        ...     lambda c: c['project_id']['archived'] is False, project=1)
+
+    :param api: The api whose installation and credentials are used
+    :param fetchers: A dictionary of the name of a reference (the field
+                     name without `_id`) to a callable which takes the api
+                     and an id and returns the object. This is added to
+                     :attr:`fetchers`.
+    :param workers: Number of objects fetched at a time
+    """
+
+    def __init__(self, api, fetchers=None, workers=4):
+        from . import Organization, Project, Comment, TaskList, Activity
+
+        self.api = api
+        self.workers = workers
+        #: The references which could be fetched, the name of the
+        #: reference to the fetcher
+        self.fetchers = {
+            'organization': _show(Organization),
+            'project': _show(Project),
+            'comment': _show(Comment),
+            'first_comment': _show(Comment),
+            'task_list': _show(TaskList),
+            'activity': _show(Activity),
+        }
+        if fetchers:
+            self.fetchers.update(fetchers)
+
+        #: The references which could not be fetched in the last load, as
+        #: a dictionary of (name, id) to the exception raised
+        self.failures = {}
+
+    def missing(self, records, types=None):
+        """Returns a dictionary of the (name, id) of each missing reference
+        which could be fetched to the reference maps it is missing from
+
+        :param types: The types of references kept in the reference maps,
+                      as given to :meth:`~teambox.BaseAPI.only`. References
+                      of the other types are left out on purpose and are
+                      not missing. All the types are kept if None.
+        """
+        missing = {}
+        for record in records:
+            for value in record.itervalues():
+                if not isinstance(value, LazyReferenceDescriptor):
+                    continue
+                name, target_id = value.target_obj, value.target_id
+                if target_id is None or name not in self.fetchers:
+                    continue
+                if types is not None and name not in types:
+                    continue
+                reference_map = value.reference_map
+                if target_id in reference_map.get(name, ()):
+                    continue
+                maps = missing.setdefault((name, target_id), [])
+                if not any(m is reference_map for m in maps):
+                    maps.append(reference_map)
+        return missing
+
+    def fetch(self, key):
+        """Fetches the object for a (name, id) and returns it as a plain
+        dictionary
+        """
+        name, target_id = key
+        result = self.fetchers[name](self.api, target_id)
+        if not isinstance(result, dict):
+            result = next(iter(result))
+        if hasattr(result, 'to_teambox_obj'):
+            result = result.to_teambox_obj()
+        return result
+
+    def load(self, records, types=None):
+        """Fetches the missing references of the records and adds them to
+        the reference maps. Returns the records.
+
+        :param types: The types of references kept, see :meth:`missing`
+        """
+        missing = self.missing(records, types)
+        self.failures = {}
+        if not missing:
+            return records
+
+        def fetch(key):
+            try:
+                return key, self.fetch(key), None
+            except Exception as exception:
+                return key, None, exception
+
+        pool = ThreadPool(min(self.workers, len(missing)))
+        try:
+            for key, obj, exception in pool.imap_unordered(fetch, missing):
+                if exception is not None:
+                    self.failures[key] = exception
+                    continue
+                name, target_id = key
+                for reference_map in missing[key]:
+                    reference_map.setdefault(name, {})[target_id] = obj
+        finally:
+            pool.close()
+
+        self.api.metrics.incr(
+            'references.loaded', len(missing) - len(self.failures)
+        )
+        self.api.metrics.incr('references.failed', len(self.failures))
+        return records
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+    loadtest
+
+    A load test harness which drives the api with many concurrent workers
+    against a local stub of teambox, to find where the client stops
+    scaling.
+
+    The stub runs in a separate process so that it does not compete with
+    the workers for the interpreter. Example::
+
+        # 50, 200 and 500 workers for 20 seconds each, 50ms of latency and
+        # 1% of the requests failing
+        $ python -m teambox.loadtest -w 50,200,500 -d 20 -l 0.05 -e 0.01
+
+        # 50 workers reading from an installation as one of its users
+        $ python -m teambox.loadtest -w 50 --url https://teambox.example.com \
+        >     -u user -p pass
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import random
+import getpass
+import resource
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from multiprocessing import Process, Queue
+
+from . import Project, Comment, TaskList, Membership, Activity
+from .pool import KeepAliveHandler
+
+
+#: The calls made by the workers as (weight, api class, method, args,
+#: kwargs). Reads are more common than writes.
+DEFAULT_MIX = [
+    (6, Project, 'index', (), {}),
+    (3, Project, 'show', (1,), {}),
+    (1, Project, 'create', ({'name': 'Load test'},), {}),
+    (6, Comment, 'index', (), {'project': 1}),
+    (3, Comment, 'show', (1,), {}),
+    (1, Comment, 'create', ({'body': 'Load test'},), {'task': 1}),
+    (6, TaskList, 'index', (1,), {}),
+    (3, TaskList, 'show', (1,), {}),
+    (1, TaskList, 'create', ({'name': 'Load test'},), {'project': 1}),
+    (3, Membership, 'index', (1,), {}),
+    (6, Activity, 'index', (1,), {}),
+]
+
+#: The calls of :data:`DEFAULT_MIX` which do not change anything, used
+#: against a real installation
+READ_ONLY_MIX = [
+    call for call in DEFAULT_MIX if call[2] not in ('create', 'update')
+]
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every request of the api with made up objects, after the
+    configured latency, or with an error at the configured rate
+    """
+    protocol_version = 'HTTP/1.1'
+
+    # Send the headers and the body of a response together, otherwise the
+    # delayed ACK of the headers holds up every keep-alive response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    #: Set by :func:`serve`
+    latency = 0
+    jitter = 0
+    error_rate = 0
+    page_size = 20
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < self.error_rate:
+            self.send_error(500)
+            return
+
+        parts = self.path.split('?', 1)[0].rstrip('/').split('/')
+        if parts[-1].isdigit():
+            body = self.record(parts[-2], int(parts[-1]))
+        elif self.command == 'GET':
+            body = self.collection(parts[-1])
+        else:
+            body = self.record(parts[-1], 1)
+        body = json.dumps(body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = respond
+
+    def record(self, kind, id):
+        return {
+            'id': id, 'type': kind.rstrip('s').title(),
+            'user_id': id % 5 + 1, 'project_id': 1,
+            'created_at': '2011-09-07 14:40:59 +0000',
+            'body': 'Lorem ipsum dolor sit amet ' * 4,
+        }
+
+    def collection(self, kind):
+        return {
+            'objects': [
+                self.record(kind, id) for id in xrange(1, self.page_size + 1)
+            ],
+            'references': [
+                {'id': id, 'type': 'User', 'username': 'user%d' % id}
+                for id in xrange(1, 6)
+            ] + [{'id': 1, 'type': 'Project', 'name': 'Load test'}],
+        }
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve(port_queue, latency=0, jitter=0, error_rate=0, port=0):
+    """Runs the stub server forever and puts its port in the queue
+    """
+    StubHandler.latency = latency
+    StubHandler.jitter = jitter
+    StubHandler.error_rate = error_rate
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_stub(latency=0, jitter=0, error_rate=0):
+    """Starts the stub server in another process. Returns the process and
+    the URL of the stub.
+    """
+    port_queue = Queue()
+    process = Process(
+        target=serve, args=(port_queue, latency, jitter, error_rate)
+    )
+    process.daemon = True
+    process.start()
+    return process, 'http://127.0.0.1:%d' % port_queue.get()
+
+
+def rss():
+    """Returns the resident memory of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # The peak is the closest on systems without /proc
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def percentile(samples, percentile):
+    """Returns the percentile (0-100) of sorted samples
+    """
+    if not samples:
+        return 0.0
+    return samples[int(round(percentile / 100.0 * (len(samples) - 1)))]
+
+
+def run(url, workers, duration, mix=None, keep_alive=True, interval=1.0,
+        username='load', password='test'):
+    """Runs the workers against the url for `duration` seconds and returns
+    a report as a dictionary.
+
+    Each worker makes calls picked at random from the mix, weighted by
+    their weights, one after the other. The instances of the apis are
+    shared by all the workers, like in a service that serves many
+    requests.
+
+    :param mix: The calls to make. Defaults to :data:`DEFAULT_MIX`.
+    :param keep_alive: Share keep-alive connections between the workers
+                       instead of a connection per request
+    :param interval: Seconds between the samples of the throughput and
+                     memory
+    :param username: The username the calls are made as
+    :param password: The password of the user
+    """
+    mix = mix or DEFAULT_MIX
+    handlers = [urllib2.HTTPCookieProcessor()]
+    if keep_alive:
+        handlers.append(KeepAliveHandler(max_idle=workers))
+    opener = urllib2.build_opener(*handlers)
+
+    apis = {}
+    for weight, api_class, method, args, kwargs in mix:
+        if api_class not in apis:
+            apis[api_class] = api_class(url, username, password)
+            apis[api_class].url_opener = opener
+    calls = []
+    for weight, api_class, method, args, kwargs in mix:
+        calls.extend(
+            [(getattr(apis[api_class], method), args, kwargs)] * weight
+        )
+
+    results = [[] for index in xrange(workers)]
+    errors = [0] * workers
+    stop = threading.Event()
+
+    def work(index):
+        latencies = results[index]
+        while not stop.is_set():
+            method, args, kwargs = random.choice(calls)
+            start = time.time()
+            try:
+                method(*args, **kwargs)
+            except Exception:
+                errors[index] += 1
+            else:
+                latencies.append(time.time() - start)
+
+    threads = [
+        threading.Thread(target=work, args=(index,))
+        for index in xrange(workers)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    timeline = []
+    while time.time() - start < duration:
+        time.sleep(interval)
+        timeline.append({
+            'time': round(time.time() - start, 2),
+            'calls': sum(len(latencies) for latencies in results),
+            'rss': rss(),
+        })
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(
+        latency for samples in results for latency in samples
+    )
+    return {
+        'workers': workers,
+        'seconds': round(elapsed, 2),
+        'calls': len(latencies),
+        'errors': sum(errors),
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.0,
+        'timeline': timeline,
+    }
+
+
+def format_report(report):
+    lines = [
+        "%(workers)d workers: %(calls)d calls, %(errors)d errors in "
+        "%(seconds)ss, %(throughput).1f calls/s" % report,
+        "  latency p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms" % tuple(
+            report[key] * 1000 for key in ('p50', 'p90', 'p99', 'max')
+        ),
+    ]
+    previous = None
+    for sample in report['timeline']:
+        calls = sample['calls'] - (previous['calls'] if previous else 0)
+        seconds = sample['time'] - (previous['time'] if previous else 0)
+        lines.append("  %6.1fs %8.1f calls/s  rss %6.1fMB" % (
+            sample['time'], calls / seconds, sample['rss'] / 1048576.0
+        ))
+        previous = sample
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage="%prog [options]",
+        description="Drives the teambox api with concurrent workers against "
+            "a local stub and reports the throughput, latency and memory."
+    )
+    parser.add_option("-w", "--workers", default="50,100,200,500",
+        help="Comma separated numbers of workers to run, one after the "
+            "other [default: %default]")
+    parser.add_option("-d", "--duration", type="float", default=10,
+        help="Seconds to run each number of workers [default: %default]")
+    parser.add_option("-l", "--latency", type="float", default=0.02,
+        help="Seconds the stub takes to answer [default: %default]")
+    parser.add_option("-j", "--jitter", type="float", default=0.01,
+        help="Random variation of the latency [default: %default]")
+    parser.add_option("-e", "--error-rate", type="float", default=0,
+        help="Fraction of requests the stub fails [default: %default]")
+    parser.add_option("--url",
+        help="Run against this installation instead of the stub. Only "
+            "calls which do not change anything are made, unless --writes "
+            "is given.")
+    parser.add_option("-u", "--username",
+        default=os.environ.get('TEAMBOX_USERNAME'),
+        help="Username for --url. Defaults to $TEAMBOX_USERNAME")
+    parser.add_option("-p", "--password",
+        default=os.environ.get('TEAMBOX_PASSWORD'),
+        help="Password for --url. Defaults to $TEAMBOX_PASSWORD. Asked for "
+            "if not given.")
+    parser.add_option("--writes", action="store_true",
+        help="Also create objects on the installation given with --url")
+    parser.add_option("--no-keep-alive", action="store_false",
+        dest="keep_alive", default=True,
+        help="Open a connection per request")
+    parser.add_option("--json", action="store_true",
+        help="Write the reports as newline delimited JSON")
+    options, args = parser.parse_args(argv)
+
+    url, mix = options.url, DEFAULT_MIX
+    credentials = ('load', 'test')
+    if url is None:
+        stub, url = start_stub(
+            options.latency, options.jitter, options.error_rate
+        )
+    else:
+        if not options.username:
+            parser.error("--username is required with --url")
+        if options.password is None:
+            options.password = getpass.getpass()
+        credentials = (options.username, options.password)
+        if not options.writes:
+            mix = READ_ONLY_MIX
+
+    for workers in options.workers.split(','):
+        report = run(
+            url, int(workers), options.duration, mix,
+            keep_alive=options.keep_alive,
+            username=credentials[0], password=credentials[1]
+        )
+        if options.json:
+            sys.stdout.write(json.dumps(report) + '\n')
+        else:
+            sys.stdout.write(format_report(report) + '\n')
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
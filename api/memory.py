@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    memory
+
+    Approximate accounting of the memory held by objectified responses
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+from collections import namedtuple
+
+from .utils import LazyReferenceDescriptor, ReferenceObj, ReferencingStream
+
+
+#: The approximate bytes held by a response, split into the objects, the
+#: reference map and the descriptors which point into it
+MemoryReport = namedtuple(
+    'MemoryReport', ['objects', 'references', 'descriptors', 'total']
+)
+
+
+def sizeof(obj, seen=None):
+    """Returns the approximate bytes held by an object and the containers,
+    strings and numbers it holds. Objects already in `seen` are not
+    counted again. Descriptors are not followed into the reference map.
+    The fields a record remembers from before it was changed are counted
+    with the record.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += sizeof(key, seen) + sizeof(value, seen)
+        if isinstance(obj, ReferenceObj):
+            size += sizeof(getattr(obj, '_original', None), seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeof(item, seen)
+    elif isinstance(obj, LazyReferenceDescriptor):
+        size += sizeof(obj.target_obj, seen) + sizeof(obj.target_id, seen)
+    return size
+
+
+#: The bytes taken by a single descriptor, with the name of the reference
+#: it holds
+DESCRIPTOR_SIZE = sizeof(LazyReferenceDescriptor('user_id', 0, None))
+
+#: The bytes a record takes over a plain dictionary of the same fields
+RECORD_OVERHEAD = sys.getsizeof(ReferenceObj()) - sys.getsizeof({})
+
+
+def measure(result):
+    """Returns a :class:`MemoryReport` for an objectified response, which
+    is an :class:`~teambox.utils.AutoReferencingList` or a subclass of it,
+    or a :class:`~teambox.utils.ReferencingStream`. The objects of a
+    stream are counted as sent by teambox, as those not yet released are.
+
+    Example::
+
+        >>> activities = Activity(username="u", password="p").index()
+        >>> measure(activities).total
+        182736
+    """
+    seen = set()
+    reference_map = getattr(result, 'reference_map', None)
+    references = sizeof(reference_map, seen) if reference_map else 0
+
+    descriptors = 0
+    if isinstance(result, ReferencingStream):
+        objects = sizeof(result.objects, seen)
+        return MemoryReport(objects, references, 0, objects + references)
+
+    objects = sys.getsizeof(result)
+    seen.add(id(result))
+    for record in list.__iter__(result):
+        if isinstance(record, ReferenceObj):
+            for value in record.itervalues():
+                if isinstance(value, LazyReferenceDescriptor):
+                    descriptors += sizeof(value, seen)
+        objects += sizeof(record, seen)
+    return MemoryReport(
+        objects, references, descriptors, objects + references + descriptors
+    )
+
+
+def _sample(items, sample):
+    """Returns at most `sample` items spread over a list
+    """
+    return items[::max(1, len(items) // sample)][:sample]
+
+
+def sample_size(items, sample=100):
+    """Returns the approximate bytes held by the items of a list, from the
+    bytes held by a sample of at most `sample` items spread over the list
+    """
+    if not items:
+        return 0
+    picked = _sample(items, sample)
+    seen = set()
+    size = sum(sizeof(item, seen) for item in picked)
+    return size * len(items) // len(picked)
+
+
+def estimate(response, reference_map, sample=100):
+    """Returns the approximate bytes of the records, the references and
+    the descriptors if a response were objectified as an
+    :class:`~teambox.utils.AutoReferencingList`, along with the bytes of
+    the response as it was decoded. Projections of the objects are not
+    taken into account, so this is an upper bound for a projected
+    response. Records are assumed to be unchanged.
+
+    The objects and references are sized from a sample of them, so that
+    the estimate takes a small part of the time objectifying takes.
+
+    :param reference_map: The reference map built from the response, see
+                          :func:`~teambox.utils.build_reference_map`
+    :param sample: Number of objects and of references sized
+    :return: A tuple of (objectified bytes, decoded bytes)
+    """
+    objects, references = response['objects'], response['references']
+    decoded = sys.getsizeof(objects) + sys.getsizeof(references) + \
+        sample_size(objects, sample) + sample_size(references, sample)
+
+    # The dictionaries of the reference map, the references themselves
+    # are already counted
+    containers = sys.getsizeof(reference_map) + sum(
+        sys.getsizeof(refs) for refs in reference_map.itervalues()
+    )
+    descriptors = 0
+    if objects:
+        picked = _sample(objects, sample)
+        descriptors = sum(
+            1 for obj in picked for key in obj if key.endswith('_id')
+        ) * len(objects) // len(picked)
+    objectified = decoded + containers + \
+        descriptors * DESCRIPTOR_SIZE + len(objects) * RECORD_OVERHEAD
+    return objectified, decoded
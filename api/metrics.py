@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Counters and latency samples collected by the api
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import threading
+from collections import defaultdict, deque
+
+
+class Metrics(object):
+    """Thread safe counters identified by name
+
+    Example::
+
+        >>> metrics = Metrics()
+        >>> metrics.incr('requests')
+        >>> metrics['requests']
+        1
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def rate(self, name, total):
+        """Returns the counter `name` as a fraction of the counter `total`
+        """
+        with self._lock:
+            total = self._counters.get(total, 0)
+            if not total:
+                return 0.0
+            return float(self._counters.get(name, 0)) / total
+
+    def snapshot(self):
+        """Returns a copy of all the counters as a dictionary
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def __repr__(self):
+        return u'<Metrics %r>' % self.snapshot()
+
+
+class LatencyTracker(object):
+    """Keeps the most recent latency samples to compute percentiles
+
+    :param size: The number of recent samples kept
+    """
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, percentile):
+        """Returns the latency at the given percentile (0-100) of the recent
+        samples or None if there are no samples
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = int(round(percentile / 100.0 * (len(samples) - 1)))
+        return samples[index]
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    multipart
+
+    Streamed multipart/form-data bodies for file uploads
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import mimetypes
+from uuid import uuid4
+
+
+def _quote(value):
+    """Returns a field name or a file name as UTF-8 to be quoted in a
+    Content-Disposition header, escaping quotes and line breaks the way
+    browsers do
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('"', '%22').replace('\r', '%0D').replace(
+        '\n', '%0A'
+    )
+
+
+class MultipartBody(object):
+    """A multipart/form-data body which is read like a file.
+
+    Files are read from the disk a chunk at a time as the body is read, so
+    the memory used does not depend on the size of the files. httplib sends
+    a body with a `read` method in blocks.
+
+    Example::
+
+        >>> body = MultipartBody(
+        ...     {'upload[description]': 'Logo'},
+        ...     {'upload[asset]': '/tmp/logo.png'})
+        >>> headers = {
+        ...     'Content-Type': body.content_type,
+        ...     'Content-Length': str(len(body))}
+
+    :param fields: A dictionary of the form fields
+    :param files: A dictionary of the form field to the path of a file
+    :param progress: A callable which is called with the bytes read so far
+                     and the total bytes each time the body is read
+    """
+
+    def __init__(self, fields=None, files=None, progress=None):
+        self.boundary = uuid4().hex
+        self.progress = progress
+
+        # The body as a list of parts which are either strings or the path
+        # of a file to be read
+        self.parts = []
+        for name, value in (fields or {}).iteritems():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            self.parts.append(
+                '--%s\r\n'
+                'Content-Disposition: form-data; name="%s"\r\n\r\n'
+                '%s\r\n' % (self.boundary, _quote(name), value)
+            )
+        for name, path in (files or {}).iteritems():
+            filename = os.path.basename(path)
+            content_type = mimetypes.guess_type(path)[0] \
+                or 'application/octet-stream'
+            self.parts.append(
+                '--%s\r\n'
+                'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                'Content-Type: %s\r\n\r\n' % (
+                    self.boundary, _quote(name), _quote(filename),
+                    content_type
+                )
+            )
+            self.parts.append(FilePart(path))
+            self.parts.append('\r\n')
+        self.parts.append('--%s--\r\n' % self.boundary)
+
+        self.length = sum(len(part) for part in self.parts)
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset):
+        """Rewinds the body so that it could be sent again. Only the start
+        of the body could be sought.
+        """
+        if offset != 0:
+            raise ValueError("A multipart body can only be rewound")
+        for part in self.parts:
+            if isinstance(part, FilePart):
+                part.close()
+        self._part = 0
+        self._offset = 0
+        self.position = 0
+
+    def read(self, size=-1):
+        """Reads up to `size` bytes of the body, or the rest of it if size
+        is negative
+        """
+        chunks = []
+        while self._part < len(self.parts) and size != 0:
+            part = self.parts[self._part]
+            if isinstance(part, FilePart):
+                chunk = part.read(size)
+            else:
+                end = len(part) if size < 0 else self._offset + size
+                chunk = part[self._offset:end]
+                self._offset += len(chunk)
+
+            if not chunk or (not isinstance(part, FilePart)
+                    and self._offset >= len(part)):
+                # This part is done, move on to the next one
+                if isinstance(part, FilePart):
+                    part.close()
+                self._part += 1
+                self._offset = 0
+            if chunk:
+                chunks.append(chunk)
+                if size > 0:
+                    size -= len(chunk)
+
+        data = ''.join(chunks)
+        self.position += len(data)
+        if data and self.progress is not None:
+            self.progress(self.position, self.length)
+        return data
+
+
+class FilePart(object):
+    """A file in a multipart body, which is opened when it is first read
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+    def read(self, size=-1):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file.read(size)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
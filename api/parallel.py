@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    parallel
+
+    Processing of objectified results on a pool of processes
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from itertools import chain, islice
+from multiprocessing import Pool
+
+from .utils import ReferenceObj
+
+
+#: The reference map installed in a worker process by :func:`_install`
+_reference_map = None
+
+
+def _install(reference_map):
+    global _reference_map
+    _reference_map = reference_map
+
+
+def _process(args):
+    """Rebuilds a chunk of records against the reference map of the worker
+    and applies the function to each of them
+    """
+    function, objects = args
+    return [
+        function(ReferenceObj.from_teambox_obj(obj, _reference_map))
+        for obj in objects
+    ]
+
+
+def chunks(records, size):
+    """Yields the records as lists of plain dictionaries of at most `size`
+    records each
+    """
+    records = iter(records)
+    while True:
+        chunk = [record.to_teambox_obj() for record in islice(records, size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_map(function, records, processes=None, chunksize=100):
+    """Applies the function to each record of an
+    :class:`~teambox.utils.AutoReferencingList` on a pool of processes and
+    returns an iterator over the results, in the order of the records.
+
+    The reference map of the list is handed to each worker process once
+    when it starts. The records are then sent in chunks as plain
+    dictionaries and rebuilt in the worker against its copy of the
+    reference map, so references work as usual in the function.
+
+    Example::
+
+        >>> def word_count(comment):
+        ...     words = len(comment['body'].split())
+        ...     return comment['user_id']['username'], words
+        >>> comments = Comment(username="u", password="p").index(project=1)
+        >>> counts = list(process_map(word_count, comments, processes=4))
+
+    :param function: A function which takes a record. It must be defined
+                     at the top level of a module so that it can be
+                     pickled.
+    :param processes: Number of worker processes. Defaults to the number
+                      of CPUs.
+    :param chunksize: Number of records sent to a worker at a time
+    """
+    pool = Pool(processes, _install, (records.reference_map,))
+    try:
+        results = pool.imap(
+            _process,
+            ((function, chunk) for chunk in chunks(records, chunksize))
+        )
+        for result in chain.from_iterable(results):
+            yield result
+    finally:
+        pool.terminate()
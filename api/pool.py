@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+    pool
+
+    Client pool for services which talk to teambox on behalf of many
+    accounts
+
+    :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import base64
+import errno
+import httplib
+import select
+import socket
+import threading
+import time
+import urllib2
+from collections import deque, defaultdict
+from StringIO import StringIO
+from urlparse import urlparse
+
+from .utils import Future
+
+
+def _closed_without_response(error):
+    """Returns True if a BadStatusLine was raised because the server closed
+    the connection without sending a single byte
+    """
+    return error.line in ("", "''") or \
+        error.line.startswith("No status line received")
+
+
+def _usable(connection):
+    """Returns True if an idle connection is still open. The server sends
+    nothing on an idle connection, so a socket with something to read has
+    been closed by the server.
+    """
+    if connection.sock is None:
+        return False
+    try:
+        readable, writable, errored = select.select(
+            [connection.sock], [], [], 0
+        )
+    except (select.error, socket.error, ValueError):
+        return False
+    return not readable
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """A handler for http and https which keeps the connections to a host
+    open and reuses them for later requests, instead of the one connection
+    per request that urllib2 does by default.
+
+    The response body is read completely before the connection is put
+    back, so the response returned is backed by a buffer.
+
+    An idle connection is only reused if it has been idle for less than
+    `max_idle_time` and the server has not closed it in the meantime, as
+    requests which are not safe to repeat cannot be sent again if they
+    fail on a connection closed by the server.
+
+    :param max_idle: The maximum number of idle connections kept per host
+    :param max_idle_time: Seconds after which an idle connection is closed
+                          instead of reused. Keep it below the keep-alive
+                          timeout of the server.
+    """
+
+    #: Methods which are sent again when a reused connection turns out to
+    #: have been closed by the server
+    idempotent_methods = frozenset(['GET', 'HEAD'])
+
+    def __init__(self, max_idle=4, max_idle_time=4):
+        urllib2.HTTPHandler.__init__(self)
+        urllib2.HTTPSHandler.__init__(self)
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.do_open(httplib.HTTPSConnection, req)
+
+    def _get_connection(self, http_class, host, timeout, tunnel=None):
+        """Returns an idle connection to the host if there is a usable one,
+        or a new connection
+
+        :param tunnel: A tuple of the host to tunnel to through the proxy
+                       at `host` and the headers of the CONNECT request
+        """
+        key = (http_class, host, tunnel and tunnel[0])
+        while True:
+            with self._lock:
+                if not self._idle[key]:
+                    break
+                connection, idle_since = self._idle[key].pop()
+            if time.time() - idle_since < self.max_idle_time and \
+                    _usable(connection):
+                return connection, True
+            connection.close()
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            connection = http_class(host)
+        else:
+            connection = http_class(host, timeout=timeout)
+        if tunnel is not None:
+            connection.set_tunnel(tunnel[0], headers=tunnel[1])
+        return connection, False
+
+    def _put_connection(self, http_class, host, connection, tunnel=None):
+        key = (http_class, host, tunnel and tunnel[0])
+        with self._lock:
+            if len(self._idle[key]) < self.max_idle:
+                self._idle[key].append((connection, time.time()))
+                return
+        connection.close()
+
+    def close(self):
+        """Closes all the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for connections in idle.itervalues():
+            for connection, idle_since in connections:
+                connection.close()
+
+    def do_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict(
+            (k, v) for k, v in req.headers.items() if k not in headers
+        ))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        # An https request through a proxy goes through a tunnel opened with
+        # CONNECT, like urllib2 does
+        tunnel = None
+        if req._tunnel_host:
+            tunnel_headers = {}
+            if 'Proxy-Authorization' in headers:
+                tunnel_headers['Proxy-Authorization'] = \
+                    headers.pop('Proxy-Authorization')
+            tunnel = (req._tunnel_host, tunnel_headers)
+
+        method = req.get_method()
+        connection, reused = self._get_connection(
+            http_class, host, req.timeout, tunnel
+        )
+        # The server may have closed a connection while it was idle. The
+        # request is sent again on a fresh connection only if that is
+        # certainly what happened and the request is safe to repeat.
+        retry = reused and method in self.idempotent_methods
+
+        try:
+            if hasattr(req.data, 'seek'):
+                req.data.seek(0)
+            connection.request(method, req.get_selector(), req.data, headers)
+        except socket.error as error:
+            connection.close()
+            if retry and not isinstance(error, socket.timeout) and \
+                    error.errno in (errno.EPIPE, errno.ECONNRESET):
+                return self.do_open(http_class, req)
+            raise urllib2.URLError(error)
+        except httplib.HTTPException as error:
+            connection.close()
+            raise urllib2.URLError(error)
+
+        try:
+            response = connection.getresponse()
+            body = response.read()
+        except httplib.BadStatusLine as error:
+            connection.close()
+            if retry and _closed_without_response(error):
+                return self.do_open(http_class, req)
+            raise urllib2.URLError(error)
+        except (socket.error, httplib.HTTPException) as error:
+            connection.close()
+            raise urllib2.URLError(error)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._put_connection(http_class, host, connection, tunnel)
+
+        result = urllib2.addinfourl(
+            StringIO(body), response.msg, req.get_full_url()
+        )
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+
+class FairScheduler(object):
+    """Runs calls on a fixed set of worker threads.
+
+    Every call is queued against a tenant and the workers take calls from
+    the tenants in turn, so a tenant which queues a lot of calls does not
+    hold back the calls of other tenants. Every call is also made against
+    a host, and not more than `per_host` calls run on a host at a time.
+
+    :param workers: Number of worker threads
+    :param per_host: Maximum number of concurrent calls for a host
+    """
+
+    def __init__(self, workers=8, per_host=4):
+        self.per_host = per_host
+        self._queues = {}
+        self._tenants = deque()
+        self._running = defaultdict(int)
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._workers = []
+        for index in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, tenant, host, function, *args, **kwargs):
+        """Queues a call and returns a :class:`~teambox.utils.Future` for
+        its result
+        """
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("The scheduler has been shut down")
+            if tenant not in self._queues:
+                self._queues[tenant] = deque()
+                self._tenants.append(tenant)
+            self._queues[tenant].append(
+                (host, future, function, args, kwargs)
+            )
+            self._condition.notify()
+        return future
+
+    def _next_call(self):
+        """Picks the call of the next tenant in turn whose host can take
+        another call. This must be called with the condition held.
+        """
+        for index in xrange(len(self._tenants)):
+            tenant = self._tenants.popleft()
+            queue = self._queues[tenant]
+            if self._running[queue[0][0]] < self.per_host:
+                call = queue.popleft()
+                if queue:
+                    self._tenants.append(tenant)
+                else:
+                    del self._queues[tenant]
+                return call
+            self._tenants.append(tenant)
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                call = self._next_call()
+                while call is None:
+                    if self._shutdown and not self._tenants:
+                        return
+                    self._condition.wait()
+                    call = self._next_call()
+                host, future, function, args, kwargs = call
+                self._running[host] += 1
+
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as exception:
+                future.set_exception(exception)
+            finally:
+                with self._condition:
+                    self._running[host] -= 1
+                    self._condition.notify_all()
+
+    def shutdown(self, wait=True):
+        """Stops the workers once the queued calls are done
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+class ClientPool(object):
+    """A pool of api instances keyed by the installation and the
+    credentials they use.
+
+    All the instances which talk to a host share the connections to the
+    host, while the cookies are kept per account. Calls submitted through
+    the pool are run on a :class:`FairScheduler` with each account as a
+    tenant.
+
+    Example::
+
+        >>> pool = ClientPool(workers=16, per_host=4)
+        >>> project_api = pool.client(Project, username="u", password="p")
+        >>> future = pool.submit(project_api, 'index')
+        >>> projects = future.result()
+
+    :param workers: Number of worker threads
+    :param per_host: Maximum number of concurrent calls for a host
+    """
+
+    def __init__(self, workers=8, per_host=4):
+        self.per_host = per_host
+        self.scheduler = FairScheduler(workers, per_host)
+        self._clients = {}
+        self._handlers = {}
+        self._openers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host(base_url):
+        """Returns the host part of the installation url
+        """
+        return urlparse(base_url).netloc
+
+    def handler(self, host):
+        """Returns the :class:`KeepAliveHandler` shared by all the clients
+        of the host
+        """
+        with self._lock:
+            if host not in self._handlers:
+                self._handlers[host] = KeepAliveHandler(
+                    max_idle=self.per_host
+                )
+            return self._handlers[host]
+
+    def opener(self, base_url, authorization):
+        """Returns the opener of an account. Every account has its own
+        cookies, so that the session of one account is never sent with the
+        requests of another, while the connections are shared through the
+        handler of the host.
+        """
+        key = (base_url, authorization)
+        handler = self.handler(self.host(base_url))
+        with self._lock:
+            if key not in self._openers:
+                self._openers[key] = urllib2.build_opener(
+                    urllib2.HTTPCookieProcessor(), handler
+                )
+            return self._openers[key]
+
+    def client(self, api_class, base_url=None, username=None, password=None):
+        """Returns an instance of the api class for the given installation
+        and credentials. The same instance is returned for every call with
+        the same arguments.
+
+        The connections of an installation with several endpoints are
+        pooled under the host of its first endpoint.
+        """
+        if base_url is None:
+            base_url = "https://teambox.com"
+        if not isinstance(base_url, basestring):
+            base_url = tuple(base_url)
+        authorization = base64.b64encode('%s:%s' % (username, password))
+        key = (api_class, base_url, authorization)
+
+        with self._lock:
+            instance = self._clients.get(key)
+        if instance is None:
+            instance = api_class(base_url, username, password)
+            instance.url_opener = self.opener(
+                instance.base_url, authorization
+            )
+            with self._lock:
+                instance = self._clients.setdefault(key, instance)
+        return instance
+
+    def submit(self, client, method, *args, **kwargs):
+        """Calls the named method of a client returned by :meth:`client`
+        on the scheduler and returns a :class:`~teambox.utils.Future` for
+        the result.
+        """
+        tenant = (client.base_url, client.headers['Authorization'])
+        return self.scheduler.submit(
+            tenant, self.host(client.base_url),
+            getattr(client, method), *args, **kwargs
+        )
+
+    def close(self):
+        """Shuts down the scheduler and closes the idle connections
+        """
+        self.scheduler.shutdown()
+        with self._lock:
+            handlers = self._handlers.values()
+        for handler in handlers:
+            handler.close()
@@ -7,7 +7,10 @@
     :copyright: (c) 2011 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import re
+import urllib
 import urllib2
+import threading
 from collections import namedtuple
 from itertools import groupby
 
@@ -26,6 +29,83 @@ class RequestWithMethod(urllib2.Request):
             else urllib2.Request.get_method(self)
         )
 
+
+def form_encode(data):
+    """Encodes a dictionary (or a list of pairs) as a form body the way
+    rails reads it. Unicode is sent as UTF-8, booleans as `true` and
+    `false` and None as an empty value.
+    """
+    if isinstance(data, dict):
+        data = data.iteritems()
+
+    pairs = []
+    for key, value in data:
+        if value is True:
+            value = 'true'
+        elif value is False:
+            value = 'false'
+        elif value is None:
+            value = ''
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        pairs.append((key, value))
+    return urllib.urlencode(pairs)
+
+
+class Future(object):
+    """The pending result of a call which runs on another thread. The
+    thread that completes the call sets either the result or the exception
+    and any thread waiting on :meth:`result` is woken up.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """Waits for the call and returns the exception it raised if any
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for the result")
+        return self._exception
+
+    def result(self, timeout=None):
+        """Waits for the call and returns its result. The exception raised
+        by the call, if any, is re-raised here.
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class Descending(object):
+    """Wraps a value to reverse its ordering, for a heap which pops the
+    largest value first
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
 data_structure = {
     u'Organization': [
         u'permalink', u'name', u'language', u'created_at', 
@@ -61,6 +141,8 @@ data_structure = {
 class LazyReferenceDescriptor(object):
     """A descriptor implementation for referencing the items from reference map
     """
+    __slots__ = ('target_obj', 'target_id', 'reference_map')
+
     def __init__(self, field_name, target_id, reference_map):
         self.target_obj = field_name.rsplit('_id', 1)[0]
         self.target_id = target_id
@@ -70,10 +152,21 @@ class LazyReferenceDescriptor(object):
         return self.reference_map[self.target_obj][self.target_id][key]
 
     def __getattr__(self, name):
+        if name.startswith('__') or \
+                name in ('target_obj', 'target_id', 'reference_map'):
+            # Special methods looked up by pickle and copy, and attributes
+            # of a descriptor which is not initialised yet
+            raise AttributeError(name)
         return getattr(
             self.reference_map[self.target_obj][self.target_id], name
             )
 
+    def __reduce__(self):
+        return (
+            self.__class__,
+            (self.target_obj + '_id', self.target_id, self.reference_map)
+        )
+
     def __repr__(self):
         return u'<%s obj (%d)>' % (self.target_obj, self.target_id)
 
@@ -81,19 +174,198 @@ class LazyReferenceDescriptor(object):
 LRD = LazyReferenceDescriptor
 
 
+def raw_value(value):
+    """Returns the id a reference points to, or the value itself if it is
+    not a reference
+    """
+    if isinstance(value, LazyReferenceDescriptor):
+        return value.target_id
+    return value
+
+
+#: Fields which are kept by every projection
+ALWAYS_PROJECTED = frozenset(['id', 'type'])
+
+
+def projection(data_dict, fields):
+    """Returns a dictionary with only the given fields of a dictionary sent
+    by teambox, and its `id` and `type`
+    """
+    return dict(
+        (k, v) for k, v in data_dict.iteritems()
+        if k in fields or k in ALWAYS_PROJECTED
+    )
+
+
+#: Marks a field which was not in the record before it was changed
+_MISSING = object()
+
+
 class ReferenceObj(dict):
     """An object which automatically translates
+
+    The fields changed after the object was built are tracked, so that only
+    those have to be sent back. See :meth:`changes`.
     """
+    # The original values of the changed fields, created on the first
+    # change so that records which are only read stay small
+    __slots__ = ('_original',)
+
+    def _remember(self, key):
+        """Remembers the value of the field before its first change
+        """
+        original = getattr(self, '_original', None)
+        if original is None:
+            original = self._original = {}
+        if key not in original:
+            original[key] = raw_value(dict.get(self, key, _MISSING))
+
+    def _forget_if_unchanged(self, key):
+        """Stops tracking a field which is back to its original value
+        """
+        if self._original[key] == raw_value(dict.get(self, key, _MISSING)):
+            del self._original[key]
+
+    def __setitem__(self, key, value):
+        self._remember(key)
+        dict.__setitem__(self, key, value)
+        self._forget_if_unchanged(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._remember(key)
+        dict.__delitem__(self, key)
+        self._forget_if_unchanged(key)
+
+    def __reduce__(self):
+        # Rebuild from a plain dictionary as unpickling would otherwise set
+        # the items through the tracking
+        original = getattr(self, '_original', None)
+        return (
+            self.__class__, (dict(self),),
+            (None, {'_original': original}) if original else None
+        )
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(iter(self))
+        return key, self.pop(key)
+
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+    @property
+    def dirty(self):
+        """The set of fields changed since the object was built or last
+        marked clean
+        """
+        return set(getattr(self, '_original', None) or ())
+
+    def changes(self, removed=False):
+        """Returns the changed fields and their new values. References are
+        given as the id they point to.
+
+        :param removed: If True, fields which were removed are given as
+                        None, which blanks them when sent to teambox. They
+                        are left out otherwise, as fields are usually
+                        removed only to save memory.
+        """
+        return dict(
+            (key, raw_value(dict.get(self, key)))
+            for key in getattr(self, '_original', None) or ()
+            if removed or key in self
+        )
+
+    def mark_clean(self):
+        """Forgets the changes, for example once they have been saved
+        """
+        self._original = None
+
+    def to_teambox_obj(self):
+        """Returns the record as a plain dictionary as sent by teambox
+        """
+        return dict((key, raw_value(value)) for key, value in self.iteritems())
 
     @classmethod
-    def from_teambox_obj(cls, data_dict, reference_map):
-        items = []
+    def from_teambox_obj(cls, data_dict, reference_map, fields=None):
+        """Builds the object from a dictionary sent by teambox
+
+        :param fields: If given, only these fields (and `id` and `type`)
+                       are kept. See :func:`projection`.
+        """
+        if fields is not None:
+            data_dict = projection(data_dict, fields)
         return cls((
             (k, (LRD(k, v, reference_map) if k.endswith('_id') else v)) \
                 for k, v in data_dict.iteritems()
         ))
 
 
+def reference_name(ref_type):
+    """Returns the name of a type of reference in the reference map, which
+    is the type in snake case as in the fields pointing to it. For example
+    references of type `TaskList` are pointed to by `task_list_id`.
+    """
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', ref_type).lower()
+
+
+def build_reference_map(references, types=None):
+    """Builds the reference map from the references of a response, keyed
+    by the :func:`reference_name` of their types
+
+    :param types: The types of references to keep. See
+                  :meth:`AutoReferencingList.from_response`.
+    """
+    if types is not None and not isinstance(types, dict):
+        types = dict.fromkeys(types)
+
+    # Step 1: rebuild references as a reference_map
+    # {
+    #   type: {
+    #       id_1: data,
+    #       id_2: data,
+    #   }
+    # }
+    sort_key = lambda reference: reference['type']
+    references = sorted(references, key=sort_key)
+    reference_map = dict()
+    for ref_type, ref_list in groupby(references, key=sort_key):
+        ref_type = reference_name(ref_type)
+        if types is None:
+            reference_map[ref_type] = dict(
+                    ((i['id'], i) for i in ref_list)
+            )
+        elif ref_type in types:
+            ref_fields = types[ref_type]
+            reference_map[ref_type] = dict((
+                (i['id'], i if ref_fields is None \
+                    else projection(i, ref_fields))
+                for i in ref_list
+            ))
+    return reference_map
+
+
 class AutoReferencingList(list):
     """The response from temabox consists of objects and references which
     complement each other. This list will be an iterator over the objects
@@ -102,26 +374,172 @@ class AutoReferencingList(list):
     """
 
     @classmethod
-    def from_response(cls, response):
+    def from_response(cls, response, fields=None, references=None):
         """Creates and returns a list which has attached reference data for
         each object.
+
+        The objects and references could be projected, so that the fields
+        which are not needed do not take up memory.
+
+        :param fields: The fields of the objects to keep. All the fields
+                       are kept if None.
+        :param references: The types of references to keep, in snake case,
+                           as a list or as a dictionary of the type to the
+                           fields to keep (None for all the fields). All
+                           the references are kept if None.
         """
-        # Step 1: rebuild references as a reference_map
-        # {
-        #   type: {
-        #       id_1: data,
-        #       id_2: data,
-        #   }
-        # }
-        sort_key = lambda reference: reference['type']
-        references = sorted(response['references'], key=sort_key)
-        reference_map = dict()
-        for ref_type, ref_list in groupby(references, key=sort_key):
-            reference_map[ref_type.lower()] = dict(
-                    ((i['id'], i) for i in ref_list)
-            )
+        return cls.from_teambox_objs(
+            response['objects'],
+            build_reference_map(response['references'], references),
+            fields
+        )
 
-        return cls((
-            ReferenceObj.from_teambox_obj(obj, reference_map) \
-                for obj in response['objects']
+    @classmethod
+    def from_teambox_objs(cls, objects, reference_map, fields=None):
+        """Creates a list of the objects referencing the given reference map
+        """
+        result = cls((
+            ReferenceObj.from_teambox_obj(obj, reference_map, fields) \
+                for obj in objects
         ))
+        result.reference_map = reference_map
+        return result
+
+    def pack(self):
+        """Returns the list in a compact form for pickling, as a tuple of
+        the reference map and the records as plain dictionaries. The
+        reference map is only included once, however many records point
+        into it. Use :meth:`unpack` to rebuild the list.
+        """
+        return (
+            self.reference_map,
+            [record.to_teambox_obj() for record in self]
+        )
+
+    @classmethod
+    def unpack(cls, packed):
+        """Rebuilds a list from the result of :meth:`pack`
+        """
+        reference_map, objects = packed
+        return cls.from_teambox_objs(objects, reference_map)
+
+    def __reduce__(self):
+        return (_unpack, (self.__class__, self.pack()))
+
+
+def _unpack(cls, packed):
+    """Unpickles an :class:`AutoReferencingList`
+    """
+    return cls.unpack(packed)
+
+
+class LeanReferencingList(AutoReferencingList):
+    """A leaner :class:`AutoReferencingList` which keeps the objects as sent
+    by teambox and builds the referencing object each time an item is
+    accessed. This saves the memory of the descriptors, at the cost of
+    building the objects again on every access.
+
+    .. note::
+
+        As the objects are not kept, changes made to them are lost unless
+        they are saved. Lists compare equal when they hold the same
+        objects as sent by teambox.
+    """
+
+    @classmethod
+    def from_teambox_objs(cls, objects, reference_map, fields=None):
+        if fields is not None:
+            objects = (projection(obj, fields) for obj in objects)
+        result = cls(objects)
+        result.reference_map = reference_map
+        return result
+
+    def _build(self, obj):
+        return ReferenceObj.from_teambox_obj(obj, self.reference_map)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._build(obj) for obj in list.__getitem__(self, index)]
+        return self._build(list.__getitem__(self, index))
+
+    def __getslice__(self, start, end):
+        return self[max(0, start):max(0, end):]
+
+    def __iter__(self):
+        for obj in list.__iter__(self):
+            yield self._build(obj)
+
+    def __reversed__(self):
+        for obj in list.__reversed__(self):
+            yield self._build(obj)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __eq__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return list.__eq__(self, [
+            obj.to_teambox_obj() if isinstance(obj, ReferenceObj) else obj
+            for obj in list.__iter__(other)
+        ])
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def pack(self):
+        return (self.reference_map, list(list.__iter__(self)))
+
+
+class ReferencingStream(object):
+    """The objects of a response as an iterable which releases the objects
+    as it advances, for responses too large to keep objectified. Like an
+    :class:`AutoReferencingList`, the stream has the `reference_map` its
+    objects point into.
+
+    The stream can be iterated only once. Use :meth:`preview` to look at
+    the objects without releasing them.
+
+    :param objects: The list of objects sent by teambox, which is emptied
+                    as the stream is iterated
+    :param reference_map: See :func:`build_reference_map`
+    :param fields: The fields of the objects to keep
+    """
+
+    def __init__(self, objects, reference_map, fields=None):
+        self.objects = objects
+        self.reference_map = reference_map
+        self.fields = fields
+
+    def __iter__(self):
+        return iter_referencing(self.objects, self.reference_map, self.fields)
+
+    def __len__(self):
+        """The number of objects not yet released
+        """
+        return len(self.objects)
+
+    def preview(self):
+        """Yields the referencing objects of the stream without releasing
+        them. Their order is only kept until the stream is iterated.
+        """
+        for obj in self.objects[:]:
+            yield ReferenceObj.from_teambox_obj(
+                obj, self.reference_map, self.fields
+            )
+
+    def __repr__(self):
+        return '<%s of %d objects>' % (self.__class__.__name__, len(self))
+
+
+def iter_referencing(objects, reference_map, fields=None):
+    """Yields referencing objects built from a list of objects sent by
+    teambox. The list is emptied as the objects are yielded, so that the
+    memory of the objects is released as the consumer advances.
+    """
+    objects.reverse()
+    while objects:
+        yield ReferenceObj.from_teambox_obj(
+            objects.pop(), reference_map, fields
+        )
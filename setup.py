@@ -30,5 +30,11 @@ setup(
     ],
     package_dir = {
         'teambox': 'api'    
-    }
+    },
+
+    entry_points = {
+        'console_scripts': [
+            'teambox = teambox.cli:main',
+        ],
+    },
 )